@@ -1,9 +1,20 @@
 import streamlit as st
-import json
+import asyncio
+import gzip
+import hashlib
+import itertools
 import os
+import re
+import threading
 import time
+import weakref
+from dataclasses import dataclass, field
+import diskcache
+import httpx
+import numpy as np
+import orjson
 from dotenv import load_dotenv
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI, RateLimitError
 
 # =========================================================
 # PAGE CONFIG
@@ -26,57 +37,786 @@ AZURE_ENDPOINT = clean_env("AZURE_OPENAI_ENDPOINT")
 AZURE_KEY = clean_env("AZURE_OPENAI_API_KEY")
 AZURE_VERSION = clean_env("AZURE_OPENAI_API_VERSION")
 DEPLOYMENT_NAME = clean_env("AZURE_OPENAI_DEPLOYMENT_NAME")
+EMBEDDING_DEPLOYMENT_NAME = clean_env("AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME") or "text-embedding-3-small"
+
+# Output budgets per call, sized to what each schema actually produces.
+# Oversized reservations eat into the TPM bucket and queue behind others.
+EXTRACT_TOKENS_PER_CHUNK = 2000
+EXTRACT_MAX_TOKENS = 16000
+# Chunks this small are not split again when their extraction is truncated.
+MIN_SPLIT_CHARS = 2000
+SYNTHESIS_MAX_TOKENS = 6000
+BC_MAPPING_MAX_TOKENS = 3000
+AL_CODE_MAX_TOKENS = 8000
+ETL_SCRIPT_MAX_TOKENS = 4000
+TEST_CASES_MAX_TOKENS = 4000
+BC_CONFIG_MAX_TOKENS = 3000
+
+MAX_CONCURRENT_REQUESTS = int(clean_env("AZURE_OPENAI_MAX_CONCURRENCY") or 8)
+CHUNKS_PER_REQUEST = int(clean_env("AZURE_OPENAI_CHUNKS_PER_REQUEST") or 4)
+MAX_REQUESTS_PER_MINUTE = int(clean_env("AZURE_OPENAI_MAX_RPM") or 1440)
+MAX_TOKENS_PER_MINUTE = int(clean_env("AZURE_OPENAI_MAX_TPM") or 240000)
 
 if not all([AZURE_ENDPOINT, AZURE_KEY, AZURE_VERSION, DEPLOYMENT_NAME]):
     st.error("Azure OpenAI environment variables are not configured correctly.")
     st.stop()
 
-client = AzureOpenAI(
-    api_key=AZURE_KEY,
-    api_version=AZURE_VERSION,
-    azure_endpoint=AZURE_ENDPOINT
-)
+# =========================================================
+# EVENT LOOP & CLIENT
+# =========================================================
+# Streamlit reruns this script on every interaction. Each browser session
+# keeps one event loop and one async client for its lifetime, side by side in
+# session_state: the client's pooled connections are bound to that loop.
+def close_async_runtime(loop, client):
+    # Also runs from garbage collection once the session is gone, on
+    # whichever thread drops the last reference. If that thread is already
+    # running a loop (e.g. Streamlit's server thread), this loop can't be
+    # driven from it, so the teardown moves to a short-lived thread.
+    if asyncio._get_running_loop() is not None:
+        threading.Thread(target=close_async_runtime, args=(loop, client), daemon=True).start()
+        return
+    if loop.is_closed():
+        return
+    try:
+        loop.run_until_complete(client.close())
+        loop.run_until_complete(loop.shutdown_asyncgens())
+    finally:
+        loop.close()
+
+class AsyncRuntime:
+    def __init__(self, config):
+        self.config = config
+        self.loop = asyncio.new_event_loop()
+        # One pooled HTTP/2 client for every Azure call in the session:
+        # requests reuse warm TLS connections and multiplex instead of
+        # handshaking each time.
+        http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+            timeout=httpx.Timeout(120.0, read=600.0)
+        )
+        self.client = AsyncAzureOpenAI(
+            api_key=AZURE_KEY,
+            api_version=AZURE_VERSION,
+            azure_endpoint=AZURE_ENDPOINT,
+            http_client=http_client
+        )
+        self._finalizer = weakref.finalize(self, close_async_runtime, self.loop, self.client)
+
+    def close(self):
+        self._finalizer()
+
+def get_async_runtime():
+    config = (AZURE_ENDPOINT, AZURE_KEY, AZURE_VERSION)
+    runtime = st.session_state.get("async_runtime")
+
+    if runtime is not None and (runtime.loop.is_closed() or runtime.config != config):
+        runtime.close()
+        runtime = None
+
+    if runtime is None:
+        runtime = AsyncRuntime(config)
+        st.session_state["async_runtime"] = runtime
+    return runtime
+
+def run_async(coro):
+    return get_async_runtime().loop.run_until_complete(coro)
+
+async def cancel_tasks(tasks):
+    # Cancel and drain the siblings of a failed task so they don't resume,
+    # and spend quota, the next time the session loop runs.
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def gather_all(*coros):
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        await cancel_tasks(tasks)
+        raise
+
+client = get_async_runtime().client
+
+# =========================================================
+# RATE LIMITING
+# =========================================================
+@dataclass
+class RateLimiter:
+    max_requests_per_minute: float
+    max_tokens_per_minute: float
+    available_request_capacity: float = field(init=False)
+    available_token_capacity: float = field(init=False)
+    last_update_time: float = field(init=False)
+    # Sessions run on their own script threads and event loops.
+    _lock: threading.Lock = field(init=False, repr=False, default_factory=threading.Lock)
+
+    def __post_init__(self):
+        self.available_request_capacity = self.max_requests_per_minute
+        self.available_token_capacity = self.max_tokens_per_minute
+        self.last_update_time = time.monotonic()
+
+    def _replenish(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update_time
+        self.available_request_capacity = min(
+            self.available_request_capacity + self.max_requests_per_minute * elapsed / 60,
+            self.max_requests_per_minute
+        )
+        self.available_token_capacity = min(
+            self.available_token_capacity + self.max_tokens_per_minute * elapsed / 60,
+            self.max_tokens_per_minute
+        )
+        self.last_update_time = now
+
+    def update_limits(self, max_requests_per_minute, max_tokens_per_minute):
+        # Keeps the current fill level so pacing carries across reruns.
+        with self._lock:
+            self._replenish()
+            self.max_requests_per_minute = max_requests_per_minute
+            self.max_tokens_per_minute = max_tokens_per_minute
+            self.available_request_capacity = min(self.available_request_capacity, max_requests_per_minute)
+            self.available_token_capacity = min(self.available_token_capacity, max_tokens_per_minute)
+
+    async def acquire(self, token_cost):
+        # A single request larger than the whole bucket would never fit.
+        token_cost = min(token_cost, self.max_tokens_per_minute)
+
+        while True:
+            with self._lock:
+                self._replenish()
+                if (self.available_request_capacity >= 1
+                        and self.available_token_capacity >= token_cost):
+                    self.available_request_capacity -= 1
+                    self.available_token_capacity -= token_cost
+                    return
+
+                request_wait = (1 - self.available_request_capacity) * 60 / self.max_requests_per_minute
+                token_wait = (token_cost - self.available_token_capacity) * 60 / self.max_tokens_per_minute
+            await asyncio.sleep(max(request_wait, token_wait, 0.05))
+
+def estimate_token_cost(messages, max_tokens):
+    prompt_chars = sum(len(m["content"]) for m in messages)
+    return prompt_chars // 4 + max_tokens
+
+def parse_retry_after(error):
+    headers = error.response.headers if error.response is not None else {}
+
+    if headers.get("retry-after-ms"):
+        return float(headers["retry-after-ms"]) / 1000
+    if headers.get("retry-after"):
+        return float(headers["retry-after"])
+
+    # e.g. "1m30s", "6s", "250ms"
+    reset = headers.get("x-ratelimit-reset-tokens") or headers.get("x-ratelimit-reset-requests")
+    if reset:
+        units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+        parts = re.findall(r"([\d.]+)(ms|s|m|h)", reset)
+        if parts:
+            return sum(float(value) * units[unit] for value, unit in parts)
+        return float(reset)
+
+    return None
+
+def rate_limit_delay(error, attempt):
+    try:
+        delay = parse_retry_after(error)
+    except ValueError:
+        delay = None
+    return delay if delay is not None else 2 ** attempt
+
+with st.sidebar:
+    st.header("⚡ Azure Throughput")
+    max_requests_per_minute = st.number_input(
+        "Max requests per minute",
+        min_value=1,
+        value=MAX_REQUESTS_PER_MINUTE,
+        step=10
+    )
+    max_tokens_per_minute = st.number_input(
+        "Max tokens per minute",
+        min_value=1000,
+        value=MAX_TOKENS_PER_MINUTE,
+        step=1000
+    )
+
+# One limiter per process: the RPM/TPM quota belongs to the Azure deployment
+# and is shared by every browser session, and rebuilding it on a rerun would
+# hand out full buckets again straight after a run that was hitting 429s.
+@st.cache_resource
+def get_rate_limiter():
+    return RateLimiter(MAX_REQUESTS_PER_MINUTE, MAX_TOKENS_PER_MINUTE)
+
+rate_limiter = get_rate_limiter()
+rate_limiter.update_limits(max_requests_per_minute, max_tokens_per_minute)
+
+# =========================================================
+# PROMPT CACHE
+# =========================================================
+# temperature=0 makes identical prompts deterministic, and Streamlit reruns
+# the whole script on every interaction, so completions are kept on disk.
+LLM_CACHE = diskcache.Cache("./.llm_cache")
+SEMANTIC_CACHE_THRESHOLD = 0.97
+
+with st.sidebar:
+    st.header("🗄 Prompt Cache")
+    use_semantic_cache = st.checkbox(
+        "Reuse answers for near-duplicate COBOL chunks",
+        value=False,
+        help="Returns a cached extraction when a chunk is ≥97% similar to one "
+             "already processed. Faster, but may miss small rule changes."
+    )
+    if st.button("Clear prompt cache"):
+        LLM_CACHE.clear()
+        # The phase results cached by st.cache_data were built from those
+        # completions; keeping them would make the next run a no-op.
+        st.cache_data.clear()
+        st.success("Prompt cache cleared.")
+
+def exact_cache_key(messages, max_tokens, response_format):
+    payload = orjson.dumps({
+        "model": DEPLOYMENT_NAME,
+        "max_tokens": max_tokens,
+        "response_format": response_format,
+        "messages": messages
+    }, option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(payload).hexdigest()
+
+def semantic_cache_key(system_prompt):
+    # Entries are single COBOL chunks compared semantically; the prompt and
+    # model they were extracted with must match exactly.
+    payload = orjson.dumps({
+        "model": DEPLOYMENT_NAME,
+        "system": system_prompt
+    }, option=orjson.OPT_SORT_KEYS)
+    return "semantic:" + hashlib.sha256(payload).hexdigest()
+
+async def embed_texts(texts):
+    # One request per batch; each chunk stays well under the embedding
+    # model's 8191-token input limit.
+    response = await client.embeddings.create(
+        model=EMBEDDING_DEPLOYMENT_NAME,
+        input=texts
+    )
+    data = sorted(response.data, key=lambda d: d.index)
+    matrix = np.array([d.embedding for d in data], dtype=np.float32)
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+def semantic_lookup(key, vector):
+    entries = LLM_CACHE.get(key, [])
+    if not entries:
+        return None
+
+    matrix = np.array([e["embedding"] for e in entries], dtype=np.float32)
+    scores = matrix @ vector
+    best = int(np.argmax(scores))
+
+    if scores[best] >= SEMANTIC_CACHE_THRESHOLD:
+        return entries[best]["response"]
+    return None
+
+def semantic_store(key, vector, response):
+    with LLM_CACHE.transact():
+        entries = LLM_CACHE.get(key, [])
+        entries.append({"embedding": vector.tolist(), "response": response})
+        LLM_CACHE.set(key, entries)
 
 # =========================================================
 # SAFE MODEL CALL
 # =========================================================
-def safe_completion(messages, max_tokens=25000, retries=3):
+class ModelCallError(Exception):
+    pass
+
+class TruncatedResponse(ModelCallError):
+    # The output hit max_tokens. At temperature 0 an identical retry is cut
+    # off at the same place, so callers must shrink the input instead.
+    pass
+
+async def read_stream(response, placeholder):
+    # Re-rendering on every token floods the websocket; a few
+    # refreshes a second is enough to watch the output grow.
+    buffer = ""
+    finish_reason = None
+    last_render = 0.0
+    async for chunk in response:
+        if not chunk.choices:
+            continue
+        finish_reason = chunk.choices[0].finish_reason or finish_reason
+        delta = chunk.choices[0].delta.content
+        if delta:
+            buffer += delta
+            now = time.monotonic()
+            if now - last_render > 0.25:
+                placeholder.code(buffer, language="json")
+                last_render = now
+
+    placeholder.code(buffer, language="json")
+    return buffer, finish_reason
+
+async def request_json(messages, max_tokens, response_format, retries=3, placeholder=None):
+    # Shared by the plain and streaming paths: exact prompt cache, rate
+    # limiting, retries and JSON parsing. Streams when given a placeholder.
+    key = exact_cache_key(messages, max_tokens, response_format)
+    cached = LLM_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    token_cost = estimate_token_cost(messages, max_tokens)
+
     for attempt in range(retries):
+        await rate_limiter.acquire(token_cost)
         try:
-            response = client.chat.completions.create(
+            response = await client.chat.completions.create(
                 model=DEPLOYMENT_NAME,
                 messages=messages,
                 temperature=0,
                 max_tokens=max_tokens,
-                response_format={"type": "json_object"}
+                response_format=response_format,
+                stream=placeholder is not None
             )
-            content = response.choices[0].message.content
-            return json.loads(content)
+            if placeholder is None:
+                content = response.choices[0].message.content
+                finish_reason = response.choices[0].finish_reason
+            else:
+                content, finish_reason = await read_stream(response, placeholder)
+
+            if finish_reason == "length":
+                raise TruncatedResponse(f"Response truncated at max_tokens={max_tokens}.")
+            result = orjson.loads(content)
+
+            LLM_CACHE.set(key, result)
+            return result
+        except TruncatedResponse:
+            raise
+        except RateLimitError as e:
+            delay = rate_limit_delay(e, attempt)
+            st.warning(f"Attempt {attempt+1} rate limited, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
         except Exception as e:
             st.warning(f"Attempt {attempt+1} failed: {e}")
-            time.sleep(2 ** attempt)
+            await asyncio.sleep(2 ** attempt)
+
+    # Raised rather than returned empty: st.cache_data never stores an
+    # exception, so a failed phase is retried on the next run.
+    raise ModelCallError(f"Model failed after {retries} attempts.")
+
+async def safe_completion(messages, max_tokens, response_format, retries=3):
+    return await request_json(messages, max_tokens, response_format, retries)
 
-    st.error("Model failed after retries.")
-    return {}
+async def safe_completion_stream(messages, placeholder, max_tokens, response_format, retries=3):
+    return await request_json(messages, max_tokens, response_format, retries, placeholder)
 
 # =========================================================
 # UTILITIES
 # =========================================================
-def split_into_chunks(text, max_lines=300):
-    lines = text.splitlines()
-    return ["\n".join(lines[i:i+max_lines]) for i in range(0, len(lines), max_lines)]
+def normalize_cobol(src):
+    # Fixed-format columns 1-6 (sequence numbers), 7 (indicator) and 73-80
+    # (identification) carry no logic but are still billed as tokens.
+    out = []
+    for ln in src.splitlines():
+        if len(ln) > 6 and ln[6] in "*/":
+            continue
+        ln = ln[7:72].rstrip()
+        if not ln:
+            continue
+        out.append(ln)
+    return "\n".join(out)
+
+# Division, section and paragraph headers start in Area A (cols 8-11) and
+# stand alone on their line, e.g. "PROCEDURE DIVISION.", "MAIN-SECTION.".
+# The optional prefix covers the sequence/indicator columns of fixed format.
+COBOL_BOUNDARY = re.compile(
+    r"^(?:[0-9 ]{6} )?[ ]{0,3}[A-Z0-9][A-Z0-9-]*(?:[ ]+(?:SECTION|DIVISION))?\.[ \t\r]*$",
+    re.M
+)
+
+NON_BLANK = re.compile(r"\S")
+
+def pack_paragraphs(text, max_chars):
+    # Walk the boundaries once, tracking offsets only; chunk text is never
+    # built up by concatenation.
+    boundaries = (m.start() for m in COBOL_BOUNDARY.finditer(text) if m.start() > 0)
+    chunk_start = 0
+    para_start = 0
 
-def dedupe_list(existing, new_items):
+    for para_end in itertools.chain(boundaries, [len(text)]):
+        if para_end - chunk_start <= max_chars:
+            para_start = para_end
+            continue
+
+        if para_start > chunk_start:
+            yield chunk_start, para_start
+
+        if para_end - para_start <= max_chars:
+            chunk_start = para_start
+        else:
+            # A single paragraph too large for one chunk: fall back to slicing.
+            for i in range(para_start, para_end, max_chars):
+                yield i, min(i + max_chars, para_end)
+            chunk_start = para_end
+
+        para_start = para_end
+
+    if len(text) > chunk_start:
+        yield chunk_start, len(text)
+
+def chunk_spans(text, max_chars=20000):
+    # Split on paragraph/section/division boundaries so no statement is cut
+    # in half, packing whole paragraphs greedily up to max_chars.
+    for start, end in pack_paragraphs(text, max_chars):
+        if NON_BLANK.search(text, start, end):
+            yield start, end
+
+def extraction_budget(batch):
+    # The structured extraction runs to roughly twice the input tokens, so
+    # the output budget follows the chunk size (~4 chars per token).
+    chars = sum(end - start for start, end in batch)
+    return EXTRACT_TOKENS_PER_CHUNK * len(batch) + chars // 2
+
+def pack_batches(spans):
+    # Several chunks share one request so RPM-bound quotas go further, but
+    # only as many as fit the output budget: a batch predicted to need more
+    # than EXTRACT_MAX_TOKENS would just be truncated and split again.
+    batch = []
+    for span in spans:
+        if batch and (len(batch) == CHUNKS_PER_REQUEST
+                      or extraction_budget(batch + [span]) > EXTRACT_MAX_TOKENS):
+            yield batch
+            batch = []
+        batch.append(span)
+
+    if batch:
+        yield batch
+
+def merge_unique(existing, new_items, seen):
+    # Hash-based, order-preserving dedupe that appends to existing in place.
+    # seen holds the keys of everything already in existing and is kept by
+    # the caller for the whole run, so each item is serialized only once.
+    # Dicts and lists are keyed on their canonical JSON.
     for item in new_items:
-        if item not in existing:
+        key = orjson.dumps(item, option=orjson.OPT_SORT_KEYS) if isinstance(item, (dict, list)) else item
+        if key not in seen:
+            seen.add(key)
             existing.append(item)
 
+# =========================================================
+# RESPONSE SCHEMAS
+# =========================================================
+# Structured outputs (json_schema, strict) guarantee every response parses
+# and matches these shapes. Strict mode requires every property to be listed
+# in "required" and additionalProperties to be false on every object.
+def strict_object(properties):
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False
+    }
+
+def array_of(items):
+    return {"type": "array", "items": items}
+
+def structured_output(name, schema):
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": name, "schema": schema, "strict": True}
+    }
+
+STRING = {"type": "string"}
+STRING_ARRAY = array_of(STRING)
+
+BUSINESS_RULE_SCHEMA = strict_object({
+    "rule_id": STRING,
+    "rule_type": {
+        "type": "string",
+        "enum": ["validation", "branch", "update", "calculation", "loop", "io"]
+    },
+    "paragraph": STRING,
+    "trigger_statement": STRING,
+    "conditions": STRING_ARRAY,
+    "actions": STRING_ARRAY,
+    "else_actions": STRING_ARRAY,
+    "go_to_targets": STRING_ARRAY,
+    "affected_fields": STRING_ARRAY,
+    "source_lines": STRING_ARRAY
+})
+
+DATA_LINEAGE_SCHEMA = strict_object({
+    "target_field": STRING,
+    "source_field": STRING,
+    "paragraph": STRING,
+    "transformation": STRING,
+    "governing_conditions": STRING_ARRAY
+})
+
+EXTRACT_SCHEMA = strict_object({
+    "program_metadata": strict_object({
+        "program_id": STRING,
+        "paragraphs": STRING_ARRAY
+    }),
+    "business_rules": array_of(BUSINESS_RULE_SCHEMA),
+    "process_flow_graph": array_of(strict_object({
+        "paragraph": STRING,
+        "entry_conditions": STRING_ARRAY,
+        "ordered_logic": array_of(strict_object({
+            "precedence_order": {"type": "integer"},
+            "condition": STRING,
+            "true_target": STRING,
+            "false_target": STRING
+        })),
+        "explicit_fallthrough": STRING,
+        "loop_structure": strict_object({
+            "is_loop": {"type": "boolean"},
+            "loop_entry": STRING,
+            "loop_exit_condition": STRING,
+            "loop_back_target": STRING
+        })
+    })),
+    "update_amend_logic": array_of(strict_object({
+        "paragraph": STRING,
+        "target_field": STRING,
+        "source_field": STRING,
+        "governing_conditions": STRING_ARRAY,
+        "material_code_condition": STRING,
+        "route_condition": STRING,
+        "calculation_logic": STRING,
+        "else_behavior": STRING,
+        "source_lines": STRING_ARRAY
+    })),
+    "material_code_governance": array_of(strict_object({
+        "material_code_range_or_value": STRING,
+        "route_condition": STRING,
+        "effect": STRING,
+        "affected_output_field": STRING,
+        "calculation_or_transformation": STRING,
+        "precedence": {"type": "integer"}
+    })),
+    "conditional_flags": STRING_ARRAY,
+    "file_io_operations": array_of(strict_object({
+        "paragraph": STRING,
+        "file": STRING,
+        "operation": STRING,
+        "result_field": STRING,
+        "success_condition": STRING,
+        "not_found_condition": STRING,
+        "failure_target": STRING
+    })),
+    "external_calls": STRING_ARRAY,
+    "data_lineage": array_of(DATA_LINEAGE_SCHEMA)
+})
+
+EXTRACT_BATCH_SCHEMA = strict_object({
+    "results": array_of(EXTRACT_SCHEMA)
+})
+
+SYNTHESIS_SCHEMA = strict_object({
+    "process_map": array_of(strict_object({
+        "paragraph": STRING,
+        "step": STRING,
+        "condition": STRING,
+        "true_target": STRING,
+        "false_target": STRING,
+        "fallthrough": STRING,
+        "rule_tags": STRING_ARRAY
+    })),
+    "business_rules": array_of(BUSINESS_RULE_SCHEMA),
+    "external_dependencies": STRING_ARRAY,
+    "risk_areas": STRING_ARRAY,
+    "data_lineage": array_of(DATA_LINEAGE_SCHEMA)
+})
+
+BC_MAPPING_ENTRY_SCHEMA = strict_object({
+    "name": STRING,
+    "cobol_source": STRING,
+    "bc_object": STRING,
+    "description": STRING,
+    "rule_ids": STRING_ARRAY
+})
+
+BC_MAPPING_SCHEMA = strict_object({
+    "bc_mapping": strict_object({
+        "tables": array_of(BC_MAPPING_ENTRY_SCHEMA),
+        "fields": array_of(BC_MAPPING_ENTRY_SCHEMA),
+        "transactions": array_of(BC_MAPPING_ENTRY_SCHEMA),
+        "validation_triggers": array_of(BC_MAPPING_ENTRY_SCHEMA),
+        "integration_endpoints": array_of(BC_MAPPING_ENTRY_SCHEMA),
+        "error_handlers": array_of(BC_MAPPING_ENTRY_SCHEMA)
+    }),
+    "dependency_map": array_of(strict_object({
+        "source": STRING,
+        "target": STRING,
+        "dependency_type": STRING
+    })),
+    "data_lineage_map": array_of(strict_object({
+        "source_field": STRING,
+        "target_table": STRING,
+        "target_field": STRING,
+        "transformation": STRING
+    }))
+})
+
+AL_CODE_SCHEMA = strict_object({
+    "al_code": STRING,
+    "rule_traceability_matrix": array_of(strict_object({
+        "rule_id": STRING,
+        "al_object": STRING,
+        "al_procedure": STRING,
+        "implemented": {"type": "boolean"}
+    })),
+    "business_rule_preservation_percent": {"type": "number"},
+    "modernization_confidence_percent": {"type": "number"}
+})
+
+ETL_SCRIPT_SCHEMA = strict_object({
+    "etl_script": STRING
+})
+
+TEST_CASES_SCHEMA = strict_object({
+    "test_cases": array_of(strict_object({
+        "test_id": STRING,
+        "rule_id": STRING,
+        "description": STRING,
+        "preconditions": STRING_ARRAY,
+        "steps": STRING_ARRAY,
+        "expected_result": STRING
+    }))
+})
+
+BC_CONFIG_SCHEMA = strict_object({
+    "environment_setup": STRING_ARRAY,
+    "number_series_setup": STRING_ARRAY,
+    "posting_setup": STRING_ARRAY,
+    "dimension_setup": STRING_ARRAY,
+    "permission_sets": STRING_ARRAY,
+    "integration_setup": STRING_ARRAY,
+    "data_migration_requirements": STRING_ARRAY,
+    "job_queue_setup": STRING_ARRAY,
+    "custom_setup_tables": STRING_ARRAY,
+    "deployment_checklist": STRING_ARRAY
+})
+
+# =========================================================
+# SHARED PROMPT PRELUDE
+# =========================================================
+# Every phase's system message starts with this exact text. Azure OpenAI
+# caches byte-identical prompt prefixes of 1024+ tokens, so it must stay a
+# plain constant: never interpolate into it or reformat it per call.
+SCHEMA_PRELUDE = """
+You are part of an enterprise pipeline that modernizes COBOL batch programs
+into Microsoft Dynamics 365 Business Central (BC) extensions written in AL.
+
+=====================================================================
+OUTPUT CONTRACT (APPLIES TO EVERY RESPONSE)
+=====================================================================
+
+1. Return STRICT JSON only. No explanation. No markdown. No commentary.
+2. The top-level value MUST be a JSON object.
+3. All keys and string values use double quotes.
+4. Booleans are lowercase true/false. Never use null.
+5. No trailing commas. No comments inside JSON.
+6. Use exactly the keys of the schema given in the task section below.
+   No additional keys. No missing keys. No renamed keys.
+7. Arrays keep source order unless the task says otherwise.
+8. Empty sections are [] or "" — never omitted.
+9. Never invent COBOL logic, fields, files or paragraphs that are not in
+   the input. Never drop logic that is in the input.
+10. Identifiers (paragraphs, fields, files, rule_ids) are copied verbatim.
+
+=====================================================================
+RULE IDENTIFIERS
+=====================================================================
+
+Business rules are identified as BR-001, BR-002, BR-003 ... Every rule has
+exactly one rule_id. A rule is one atomic decision or assignment. When a
+later phase refers to a rule it uses the same rule_id, unchanged.
+
+=====================================================================
+COBOL GLOSSARY
+=====================================================================
+
+DIVISION        Top-level program part: IDENTIFICATION, ENVIRONMENT, DATA,
+                PROCEDURE.
+SECTION         Named group of paragraphs, or a part of a division such as
+                FILE SECTION or WORKING-STORAGE SECTION.
+PARAGRAPH       Named block of statements in the PROCEDURE DIVISION; the unit
+                targeted by PERFORM and GO TO.
+PERFORM         Call a paragraph (or range with THRU) and return; PERFORM
+                UNTIL / VARYING expresses a loop.
+GO TO           Unconditional jump to a paragraph; a jump to an earlier
+                paragraph forms a loop.
+FALLTHROUGH     Execution continuing into the next paragraph without an
+                explicit transfer of control.
+EVALUATE        Multi-branch decision (WHEN / WHEN OTHER); never reduce it to
+                a binary IF.
+88-LEVEL        Condition name bound to values of a field, used as a flag.
+PIC / PICTURE   Field format: X = alphanumeric, 9 = numeric, V = implied
+                decimal point, S = sign.
+COMP / COMP-3   Binary / packed-decimal storage of a numeric field.
+REDEFINES       Alternative layout over the same storage.
+OCCURS          Repeating group (array); may be DEPENDING ON a count field.
+FD              File description; the record layout of a file.
+FILE STATUS     Two-character result code of file I/O ('00' ok, '10' end of
+                file, '23' record not found).
+READ / WRITE / REWRITE / DELETE / START
+                Record I/O; AT END and INVALID KEY clauses define the
+                not-found and failure paths.
+MOVE            Assignment; MOVE CORRESPONDING copies same-named subfields.
+COMPUTE / ADD / SUBTRACT / MULTIPLY / DIVIDE
+                Arithmetic assignment; ROUNDED and ON SIZE ERROR matter.
+CALL            Invocation of an external program (an external dependency).
+COPY            Copybook inclusion of shared record layouts.
+
+=====================================================================
+BUSINESS CENTRAL GLOSSARY
+=====================================================================
+
+TABLE               Persistent entity (e.g. Item, Vendor, Production Order).
+TABLEEXTENSION      Adds fields or triggers to a standard BC table.
+PAGE / PAGEEXTENSION
+                    User interface over a table.
+CODEUNIT            Unit of AL business logic; the target for procedural
+                    COBOL paragraphs.
+REPORT              Batch processing or printed output over table data.
+XMLPORT             File import/export; replaces sequential file I/O.
+QUERY               Read-only joined dataset.
+ENUM                Closed set of values; replaces 88-level flags.
+TRIGGER             OnInsert, OnModify, OnDelete, OnValidate hooks on tables
+                    and fields; target for validation rules.
+EVENT SUBSCRIBER    Hook into standard BC events without modifying base code.
+NUMBER SERIES       Automatic document and record numbering.
+POSTING SETUP       General, inventory and vendor posting groups that route
+                    ledger entries.
+DIMENSIONS          Analytical tags (department, project) on entries.
+PERMISSION SET      Access rights for objects and data.
+JOB QUEUE           Scheduled execution of codeunits and reports; replaces
+                    batch job scheduling.
+API PAGE            OData/REST endpoint for integrations.
+
+=====================================================================
+MAPPING CONVENTIONS
+=====================================================================
+
+• Indexed COBOL files map to BC tables; the RECORD KEY becomes the
+  primary key.
+• Sequential input files map to XMLports or API-based staging tables.
+• Paragraphs holding business decisions map to codeunit procedures.
+• Field validations map to OnValidate triggers.
+• Status flags and 88-levels map to enums or boolean fields.
+• Batch main loops map to job-queue-driven codeunits or reports.
+• Every generated artifact remains traceable to its source rule_id.
+
+=====================================================================
+TASK
+=====================================================================
+"""
+
 # =========================================================
 # PHASE 1 – EXTRACTION
 # =========================================================
-def extract_from_large_cobol(cobol_code):
+async def extract_from_large_cobol(cobol_code, use_semantic_cache=False):
 
-    system_prompt = """
+    system_prompt = SCHEMA_PRELUDE + """
 You are a STATIC COBOL EXECUTION INTELLIGENCE ENGINE.
 
 Your responsibility is to reconstruct executable COBOL logic EXACTLY as it executes.
@@ -333,13 +1073,35 @@ All keys must use double quotes.
 Booleans must be lowercase true/false.
 No trailing commas.
 """
-    chunks = split_into_chunks(cobol_code)
+    batch_prompt = system_prompt + """
+=====================================================================
+BATCHED INPUT
+=====================================================================
+
+The user message contains one or more COBOL chunks, each introduced by a
+delimiter line of the form ---CHUNK n---.
+
+Apply ALL of the rules above to EACH chunk independently and return:
+
+{
+  "results": [ { ...extraction schema for chunk 1... }, { ...chunk 2... } ]
+}
+
+Exactly one entry per delimited chunk, in the same order as the input.
+"""
+    # Only (start, end) offsets are materialized; each chunk's text is sliced
+    # when its batch request is built.
+    spans = list(chunk_spans(cobol_code))
+    batches = list(pack_batches(spans))
 
+    # Mirrors EXTRACT_SCHEMA: strict structured outputs can't return any
+    # other key.
     aggregated = {
-        "purpose": "",
-        "entities": [],
+        "program_metadata": {"program_id": "", "paragraphs": []},
         "business_rules": [],
-        "control_flow": [],
+        "process_flow_graph": [],
+        "update_amend_logic": [],
+        "material_code_governance": [],
         "conditional_flags": [],
         "file_io_operations": [],
         "external_calls": [],
@@ -347,34 +1109,139 @@ No trailing commas.
     }
 
     progress = st.progress(0)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
-    for i, chunk in enumerate(chunks):
+    semantic_key = semantic_cache_key(batch_prompt)
+
+    async def request_extraction(batch):
+        user_content = "\n".join(
+            f"---CHUNK {n}---\n{cobol_code[start:end]}"
+            for n, (start, end) in enumerate(batch, start=1)
+        )
         messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": chunk}
+            {"role": "system", "content": batch_prompt},
+            {"role": "user", "content": user_content}
         ]
-
-        result = safe_completion(messages)
-        if not result:
-            continue
-
-        for key in aggregated:
-            if key == "purpose":
-                if not aggregated["purpose"]:
-                    aggregated["purpose"] = result.get("purpose", "")
-            else:
-                dedupe_list(aggregated[key], result.get(key, []))
-
-        progress.progress((i + 1) / len(chunks))
+        # Batches are packed to fit the budget; the cap only matters for a
+        # single oversized chunk, which the truncation path then re-splits.
+        max_tokens = min(EXTRACT_MAX_TOKENS, extraction_budget(batch))
+
+        result = await safe_completion(
+            messages,
+            max_tokens=max_tokens,
+            response_format=structured_output("extract_batch", EXTRACT_BATCH_SCHEMA)
+        )
+
+        per_chunk = result.get("results", [])
+        if not isinstance(per_chunk, list) or len(per_chunk) != len(batch):
+            raise ModelCallError(
+                f"Extraction returned {len(per_chunk)} results for {len(batch)} chunks."
+            )
+        return per_chunk
+
+    async def request_batch(batch):
+        # The semantic cache works per chunk: near-duplicate chunks are
+        # answered from cache and only the rest of the batch is sent.
+        # Chunk text is only sliced once a slot is free, so at most
+        # MAX_CONCURRENT_REQUESTS batches are held in memory at a time.
+        async with semaphore:
+            results = [None] * len(batch)
+            vectors = None
+            if use_semantic_cache:
+                try:
+                    vectors = await embed_texts([cobol_code[start:end] for start, end in batch])
+                except Exception as e:
+                    st.warning(f"Semantic cache lookup skipped: {e}")
+                else:
+                    results = [semantic_lookup(semantic_key, v) for v in vectors]
+
+            pending = [i for i, result in enumerate(results) if result is None]
+            if pending:
+                per_chunk = await request_extraction([batch[i] for i in pending])
+                for i, result in zip(pending, per_chunk):
+                    results[i] = result
+                    if vectors is not None:
+                        semantic_store(semantic_key, vectors[i], result)
+
+            return results
+
+    async def extract_spans(batch):
+        try:
+            return await request_batch(batch)
+        except TruncatedResponse:
+            # Shrink the request instead of retrying it unchanged: halve the
+            # batch, or re-split a lone chunk at paragraph boundaries.
+            if len(batch) > 1:
+                mid = len(batch) // 2
+                halves = await gather_all(extract_spans(batch[:mid]), extract_spans(batch[mid:]))
+                return halves[0] + halves[1]
+
+            start, end = batch[0]
+            if end - start <= MIN_SPLIT_CHARS:
+                raise
+            pieces = [
+                (start + a, start + b)
+                for a, b in chunk_spans(cobol_code[start:end], (end - start + 1) // 2)
+            ]
+            if not pieces:
+                raise
+            return await extract_spans(pieces)
+
+    async def extract_batch(index, batch):
+        return index, len(batch), await extract_spans(batch)
+
+    list_keys = [key for key in aggregated if key != "program_metadata"]
+    seen = {key: set() for key in list_keys}
+    seen_paragraphs = set()
+
+    def merge_result(result):
+        if not isinstance(result, dict) or not result:
+            return
+
+        metadata = result.get("program_metadata") or {}
+        program = aggregated["program_metadata"]
+        if not program["program_id"]:
+            program["program_id"] = metadata.get("program_id", "")
+        merge_unique(program["paragraphs"], metadata.get("paragraphs", []), seen_paragraphs)
+
+        for key in list_keys:
+            merge_unique(aggregated[key], result.get(key, []), seen[key])
+
+    # Batches are independent, so fire them all at once. Results are merged
+    # in source order (the extraction contract, and later rule numbering,
+    # depend on it): each completed batch is parked until every batch before
+    # it has landed, then the contiguous prefix is folded in while the
+    # remaining requests are still in flight.
+    tasks = [asyncio.create_task(extract_batch(i, batch)) for i, batch in enumerate(batches)]
+    parked = {}
+    next_index = 0
+    chunks_done = 0
+
+    try:
+        for future in asyncio.as_completed(tasks):
+            index, batch_len, per_chunk = await future
+            parked[index] = per_chunk
+
+            while next_index in parked:
+                for result in parked.pop(next_index):
+                    merge_result(result)
+                next_index += 1
+
+            chunks_done += batch_len
+            progress.progress(chunks_done / len(spans))
+    except BaseException:
+        # One failed batch fails the extraction; don't leave the rest running.
+        await cancel_tasks(tasks)
+        raise
 
     return aggregated
 
 # =========================================================
 # PHASE 2 – SYNTHESIS
 # =========================================================
-def synthesize_model(extracted):
+async def synthesize_model(extracted):
 
-    system_prompt = """
+    system_prompt = SCHEMA_PRELUDE + """
 You MUST:
 - Preserve rule_id tags inside every process step
 - Represent ordered IF/ELSE branching correctly
@@ -397,18 +1264,80 @@ Return STRICT JSON:
 
     messages = [
         {"role": "system", "content": system_prompt},
-        {"role": "user", "content": json.dumps(extracted)}
+        {"role": "user", "content": orjson.dumps(extracted).decode()}
     ]
 
-    return safe_completion(messages)
+    return await safe_completion(
+        messages,
+        max_tokens=SYNTHESIS_MAX_TOKENS,
+        response_format=structured_output("synthesis", SYNTHESIS_SCHEMA)
+    )
+
+# Below this many extracted rules the LLM synthesis pass may still add value.
+MIN_RULES_FOR_LOCAL_SYNTHESIS = 5
+
+def reshape_extraction(extracted):
+    # Phase 1 already emits rule-tagged, structured output, so the synthesis
+    # schema can be filled locally instead of paying for another round-trip.
+    return {
+        "process_map": extracted.get("process_flow_graph", []),
+        "business_rules": extracted.get("business_rules", []),
+        "external_dependencies": extracted.get("external_calls", []),
+        "risk_areas": [],
+        "data_lineage": extracted.get("data_lineage", [])
+    }
 
 # =========================================================
 # PHASE 3 – MODERNIZATION
 # =========================================================
-def generate_modernization_artifacts(synthesized):
+async def generate_by_rule_subset(synthesized, generate, merge, placeholder=None):
+    # The phase-3 counterpart of halving a truncated extraction batch: when
+    # an artifact outgrows its budget, generate it for each half of the
+    # business rules and merge the two. Retrying unchanged would truncate
+    # at the same place.
+    try:
+        return await generate(synthesized, placeholder)
+    except TruncatedResponse:
+        rules = synthesized.get("business_rules", [])
+        if len(rules) < 2:
+            raise
+        if placeholder is not None:
+            placeholder.empty()
+
+        mid = len(rules) // 2
+        halves = await gather_all(
+            generate_by_rule_subset({**synthesized, "business_rules": rules[:mid]}, generate, merge),
+            generate_by_rule_subset({**synthesized, "business_rules": rules[mid:]}, generate, merge)
+        )
+        return merge(*halves)
+
+def merge_al_code(first, second):
+    # The percentages are weighted by how many rules each half traced.
+    first_rules = len(first["rule_traceability_matrix"])
+    second_rules = len(second["rule_traceability_matrix"])
+    if not first_rules + second_rules:
+        first_rules = second_rules = 1
+
+    def weighted(key):
+        total = first_rules + second_rules
+        return round((first[key] * first_rules + second[key] * second_rules) / total, 2)
+
+    return {
+        "al_code": first["al_code"] + "\n\n" + second["al_code"],
+        "rule_traceability_matrix": first["rule_traceability_matrix"] + second["rule_traceability_matrix"],
+        "business_rule_preservation_percent": weighted("business_rule_preservation_percent"),
+        "modernization_confidence_percent": weighted("modernization_confidence_percent")
+    }
+
+def merge_test_cases(first, second):
+    return {"test_cases": first["test_cases"] + second["test_cases"]}
+
+async def generate_modernization_artifacts(synthesized):
 
-    system_prompt = """
-Generate BC modernization artifacts.
+    # The artifacts are independent of each other, so each gets its own
+    # narrow prompt and all four are generated concurrently.
+    bc_mapping_prompt = SCHEMA_PRELUDE + """
+Generate the Business Central object mapping for the modernized program.
 
 Return STRICT JSON:
 {
@@ -420,30 +1349,102 @@ Return STRICT JSON:
       "integration_endpoints": [],
       "error_handlers": []
   },
-  "al_code": "",
-  "etl_script": "",
-  "test_cases": [],
   "dependency_map": [],
-  "data_lineage_map": [],
+  "data_lineage_map": []
+}
+"""
+
+    al_code_prompt = SCHEMA_PRELUDE + """
+Generate the AL code implementing every business rule.
+Every rule_id must be traceable to the AL object/procedure implementing it.
+
+Return STRICT JSON:
+{
+  "al_code": "",
   "rule_traceability_matrix": [],
   "business_rule_preservation_percent": 0,
   "modernization_confidence_percent": 0
 }
 """
 
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": json.dumps(synthesized)}
-    ]
+    etl_script_prompt = SCHEMA_PRELUDE + """
+Generate the Python ETL script migrating the COBOL file data into the
+Business Central tables.
 
-    return safe_completion(messages)
+Return STRICT JSON:
+{
+  "etl_script": ""
+}
+"""
+
+    test_cases_prompt = SCHEMA_PRELUDE + """
+Generate test cases covering every business rule, including ELSE and
+fallthrough paths. Each test case references the rule_id it covers.
+
+Return STRICT JSON:
+{
+  "test_cases": []
+}
+"""
+
+    def messages_for(system_prompt, model=synthesized):
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": orjson.dumps(model).decode()}
+        ]
+
+    async def al_code_for(model, placeholder=None):
+        if placeholder is None:
+            return await safe_completion(
+                messages_for(al_code_prompt, model),
+                max_tokens=AL_CODE_MAX_TOKENS,
+                response_format=structured_output("al_code", AL_CODE_SCHEMA)
+            )
+        return await safe_completion_stream(
+            messages_for(al_code_prompt, model),
+            placeholder,
+            max_tokens=AL_CODE_MAX_TOKENS,
+            response_format=structured_output("al_code", AL_CODE_SCHEMA)
+        )
+
+    async def test_cases_for(model, placeholder=None):
+        return await safe_completion(
+            messages_for(test_cases_prompt, model),
+            max_tokens=TEST_CASES_MAX_TOKENS,
+            response_format=structured_output("test_cases", TEST_CASES_SCHEMA)
+        )
+
+    # AL code is the largest generation in the pipeline: stream it so it
+    # appears as it is produced instead of after the whole response.
+    with st.spinner("Generating modernization artifacts..."):
+        preview = st.empty()
+        results = await gather_all(
+            safe_completion(
+                messages_for(bc_mapping_prompt),
+                max_tokens=BC_MAPPING_MAX_TOKENS,
+                response_format=structured_output("bc_mapping", BC_MAPPING_SCHEMA)
+            ),
+            generate_by_rule_subset(synthesized, al_code_for, merge_al_code, preview),
+            safe_completion(
+                messages_for(etl_script_prompt),
+                max_tokens=ETL_SCRIPT_MAX_TOKENS,
+                response_format=structured_output("etl_script", ETL_SCRIPT_SCHEMA)
+            ),
+            generate_by_rule_subset(synthesized, test_cases_for, merge_test_cases)
+        )
+    preview.empty()
+
+    modernized = {}
+    for result in results:
+        modernized.update(result)
+    return modernized
 
 # =========================================================
 # BC CONFIG GENERATION
 # =========================================================
-def generate_bc_configuration(synthesized, modernized):
+async def generate_bc_configuration(synthesized):
 
-    system_prompt = """
+    system_prompt = SCHEMA_PRELUDE + """
 Generate required Business Central configuration checklist.
 
 Return STRICT JSON:
@@ -462,15 +1463,71 @@ Return STRICT JSON:
 """
     messages = [
         {"role": "system", "content": system_prompt},
-        {"role": "user", "content": json.dumps({
-            "synthesized": synthesized,
-            "modernized": modernized
-        })}
+        {"role": "user", "content": orjson.dumps({
+            "synthesized": synthesized
+        }).decode()}
     ]
 
-    return safe_completion(messages)
+    return await safe_completion(
+        messages,
+        max_tokens=BC_CONFIG_MAX_TOKENS,
+        response_format=structured_output("bc_config", BC_CONFIG_SCHEMA)
+    )
+
+
+
+# =========================================================
+# PIPELINE
+# =========================================================
+# Phase results are cached on their inputs so switching tabs or re-uploading
+# the same file never re-runs the pipeline.
+@st.cache_data(show_spinner=False)
+def run_extraction(cobol_code, use_semantic_cache=False):
+    # use_semantic_cache changes what comes back, so it is part of the key.
+    return run_async(extract_from_large_cobol(cobol_code, use_semantic_cache))
+
+@st.cache_data(show_spinner=False)
+def run_synthesis(extracted):
+    return run_async(synthesize_model(extracted))
+
+async def generate_phase3(synthesized):
+    # The BC configuration checklist only needs the synthesized model, so it
+    # is generated alongside the artifacts instead of after them.
+    return await gather_all(
+        generate_modernization_artifacts(synthesized),
+        generate_bc_configuration(synthesized)
+    )
+
+@st.cache_data(show_spinner=False)
+def run_phase3(synthesized):
+    modernized, bc_config = run_async(generate_phase3(synthesized))
+    return modernized, bc_config
+
+def run_modernization(cobol_code, llm_synthesis=False, use_semantic_cache=False, status=None):
+
+    def step(label):
+        if status is not None:
+            status.update(label=label)
+            status.write(label)
 
+    step("Phase 1 – extracting business rules...")
+    extracted = run_extraction(cobol_code, use_semantic_cache)
 
+    step("Phase 2 – synthesizing process model...")
+    if llm_synthesis or len(extracted.get("business_rules", [])) < MIN_RULES_FOR_LOCAL_SYNTHESIS:
+        synthesized = run_synthesis(extracted)
+    else:
+        synthesized = reshape_extraction(extracted)
+
+    step("Phase 3 – generating BC artifacts and configuration...")
+    modernized, bc_config = run_phase3(synthesized)
+
+    return {
+        "extracted": extracted,
+        "synthesized": synthesized,
+        "modernized": modernized,
+        "bc_config": bc_config
+    }
 
 # =========================================================
 # RULE COVERAGE
@@ -536,28 +1593,50 @@ with tab_upload:
         cobol_code = uploaded.read().decode("utf-8")
         st.code(cobol_code[:2000])
 
-        if st.button("Run Enterprise Modernization", use_container_width=True):
-
-            extracted = extract_from_large_cobol(cobol_code)
-            synthesized = synthesize_model(extracted)
-            modernized = generate_modernization_artifacts(synthesized)
-            bc_config = generate_bc_configuration(synthesized, modernized)
-            
+        keep_formatting = st.checkbox(
+            "Keep original formatting",
+            value=False,
+            help="Send the source as uploaded, including sequence numbers, "
+                 "comment lines and column padding. Needed for free-format COBOL."
+        )
+        if not keep_formatting:
+            cobol_code = normalize_cobol(cobol_code)
+
+        llm_synthesis = st.checkbox(
+            "Refine with LLM synthesis (advanced)",
+            value=False,
+            help="Run an extra model pass over the extracted rules. By default "
+                 "the extraction is reshaped locally, which is much faster."
+        )
 
-            st.session_state["analysis"] = {
-                "extracted": extracted,
-                "synthesized": synthesized,
-                "modernized": modernized,
-                "bc_config": bc_config
-                
-            }
+        if st.button("Run Enterprise Modernization", use_container_width=True):
 
-            st.success("Modernization Complete.")
+            error = None
+            with st.status("Running modernization...", expanded=True) as status:
+                try:
+                    st.session_state["analysis"] = run_modernization(
+                        cobol_code, llm_synthesis, use_semantic_cache, status
+                    )
+                except TruncatedResponse as e:
+                    error = (f"{e} The output is too large for its token budget, so "
+                             "running again will fail the same way. "
+                             "Split the program or raise the *_MAX_TOKENS budget.")
+                    status.update(label="Modernization failed", state="error")
+                except ModelCallError as e:
+                    error = f"{e} Run again to retry the failed phase."
+                    status.update(label="Modernization failed", state="error")
+                else:
+                    status.update(label="Modernization finished", state="complete", expanded=False)
+
+            if error:
+                st.error(error)
+            else:
+                st.success("Modernization Complete.")
 
 # =========================================================
 # LOAD DATA
 # =========================================================
-analysis = st.session_state.get("analysis", {})
+analysis = st.session_state.setdefault("analysis", None) or {}
 extracted = analysis.get("extracted", {})
 synthesized = analysis.get("synthesized", {})
 modernized = analysis.get("modernized", {})
@@ -567,38 +1646,72 @@ bc_config = analysis.get("bc_config", {})
 # =========================================================
 # RENDER TABS
 # =========================================================
+JSON_PAGE_SIZE = 50
+
+def require_analysis():
+    if not analysis:
+        st.info("Run modernization first.")
+        return False
+    return True
+
+def render_json(data, key):
+    # Streamlit re-sends every element on each rerun, so large arrays are
+    # shown a page at a time and objects start collapsed.
+    if not require_analysis():
+        return
+
+    if isinstance(data, list) and len(data) > JSON_PAGE_SIZE:
+        pages = (len(data) + JSON_PAGE_SIZE - 1) // JSON_PAGE_SIZE
+        page = st.number_input(
+            f"Page (1-{pages})",
+            min_value=1,
+            max_value=pages,
+            value=1,
+            key=f"{key}_page"
+        )
+        start = (page - 1) * JSON_PAGE_SIZE
+        st.caption(f"Items {start + 1}-{min(start + JSON_PAGE_SIZE, len(data))} of {len(data)}")
+        st.json(data[start:start + JSON_PAGE_SIZE])
+    elif isinstance(data, dict):
+        st.json(data, expanded=False)
+    else:
+        st.json(data)
+
 with tab_rules:
-    st.json(extracted.get("business_rules", []))
+    render_json(extracted.get("business_rules", []), "rules")
 
 with tab_process:
-    st.json(synthesized.get("process_map", []))
+    render_json(synthesized.get("process_map", []), "process")
 
 with tab_dependencies:
-    st.json(modernized.get("dependency_map", []))
+    render_json(modernized.get("dependency_map", []), "dependencies")
 
 with tab_bc:
-    st.json(modernized.get("bc_mapping", {}))
+    render_json(modernized.get("bc_mapping", {}), "bc_mapping")
 
 with tab_bc_config:
-    st.json(bc_config)
+    render_json(bc_config, "bc_config")
 
 with tab_al:
-    st.code(modernized.get("al_code", ""), language="al")
+    if require_analysis():
+        st.code(modernized.get("al_code", ""), language="al")
 
 with tab_etl:
-    st.code(modernized.get("etl_script", ""), language="python")
+    if require_analysis():
+        st.code(modernized.get("etl_script", ""), language="python")
 
 with tab_tests:
-    st.json(modernized.get("test_cases", []))
+    render_json(modernized.get("test_cases", []), "tests")
 
 with tab_lineage:
-    st.json(modernized.get("data_lineage_map", []))
+    render_json(modernized.get("data_lineage_map", []), "lineage")
 
 with tab_metrics:
-    st.metric("Rule Preservation",
-              modernized.get("business_rule_preservation_percent", 0))
-    st.metric("Modernization Confidence",
-              modernized.get("modernization_confidence_percent", 0))
+    if require_analysis():
+        st.metric("Rule Preservation",
+                  modernized.get("business_rule_preservation_percent", 0))
+        st.metric("Modernization Confidence",
+                  modernized.get("modernization_confidence_percent", 0))
 
 
 # =========================================================
@@ -856,12 +1969,20 @@ with tab_full:
     # =====================================================
     # ⬇ DOWNLOAD
     # =====================================================
-    st.download_button(
-        "Download Validated Enterprise Model",
-        data=json.dumps(model, indent=2),
-        file_name="validated_enterprise_model.json",
-        mime="application/json"
-    )
+    # The payload is only built on request: download_button evaluates its
+    # data on every rerun, and multi-MB models made every tab click pay for it.
+    @st.cache_data(show_spinner=False)
+    def build_model_download(model):
+        payload = orjson.dumps(model, option=orjson.OPT_INDENT_2)
+        return gzip.compress(payload)
+
+    if st.button("Prepare Validated Enterprise Model Download"):
+        st.download_button(
+            "Download Validated Enterprise Model",
+            data=build_model_download(model),
+            file_name="validated_enterprise_model.json.gz",
+            mime="application/gzip"
+        )
 
 st.markdown("---")
 st.markdown("⚠️ Enterprise validation required before production deployment.")